@@ -0,0 +1,200 @@
+import math
+import mmap
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+# Compact area index shipped with the backend; override with GAZETTEER_PATH for other regions
+GAZETTEER_PATH = (os.getenv('GAZETTEER_PATH', '') or '').strip() or os.path.join(
+    os.path.dirname(__file__), 'data', 'gazetteer.tsv')
+# Neighbour ring outer radii in km: ring 1 = within 5 km, ring 2 = 5-12 km
+RING_RADII_KM = (5.0, 12.0)
+# Tokens allowed straight after an alias. Anything else (e.g. the "e" in "Gulshan-e-Maymar" or
+# "view" in "Defence View") means the alias is only the start of a different place name.
+ADDRESS_FOLLOWERS = {
+    'phase', 'ph', 'block', 'blk', 'sector', 'street', 'st', 'road', 'rd', 'lane', 'house',
+    'plot', 'near', 'main', 'area', 'pakistan', 'ii', 'iii', 'iv', 'v',
+}
+_COLUMNS = {'C': 4, 'A': 7}
+_UNSET = object()
+
+
+@dataclass
+class Area:
+    area_id: str
+    city_id: str
+    name: str
+    lat: float
+    lon: float
+    aliases: tuple
+    rings: tuple = field(default_factory=tuple)  # tuple of tuples of area_ids, nearest ring first
+
+
+@dataclass
+class ResolvedLocation:
+    """Canonical form of a free-text location plus its deterministic nearby-area fan-out."""
+    area_id: str
+    name: str
+    city: str
+    nearby: list  # display names of neighbouring areas, nearest first
+
+    @property
+    def display(self):
+        return self.name if self.city.lower() in self.name.lower() else f"{self.name}, {self.city}"
+
+
+def normalize_text(text: str) -> tuple:
+    """Lowercase and split on anything that isn't a letter or digit ("Bahria-Town, KHI" -> bahria town khi)."""
+    return tuple(re.findall(r'[a-z0-9]+', (text or '').lower()))
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+def _contains(tokens: tuple, phrase: tuple) -> bool:
+    n = len(phrase)
+    return any(tokens[i:i + n] == phrase for i in range(len(tokens) - n + 1))
+
+
+def _contains_at_boundary(tokens: tuple, phrase: tuple, boundary: set) -> bool:
+    """Like _contains, but the phrase must end the text or be followed by an address/city token."""
+    n = len(phrase)
+    for i in range(len(tokens) - n + 1):
+        if tokens[i:i + n] != phrase:
+            continue
+        nxt = tokens[i + n] if i + n < len(tokens) else None
+        if nxt is None or nxt in boundary or nxt in ADDRESS_FOLLOWERS or any(c.isdigit() for c in nxt):
+            return True
+    return False
+
+
+class Gazetteer:
+    """In-memory index built from the memory-mapped gazetteer file."""
+
+    def __init__(self, path: str):
+        self.cities = {}  # city_id -> (display name, alias token tuples)
+        self.areas = {}   # area_id -> Area
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for lineno, raw in enumerate(iter(mm.readline, b''), start=1):
+                line = raw.decode('utf-8').rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                cols = line.split('\t')
+                expected = _COLUMNS.get(cols[0])
+                if expected is None:
+                    raise ValueError(f"{path}:{lineno}: unknown row type {cols[0]!r}")
+                if len(cols) != expected:
+                    raise ValueError(f"{path}:{lineno}: {cols[0]} row needs {expected} columns, got {len(cols)}")
+                if cols[0] == 'C':
+                    _, city_id, name, aliases = cols
+                    self.cities[city_id] = (name, tuple(normalize_text(a) for a in aliases.split('|')))
+                elif cols[0] == 'A':
+                    _, area_id, city_id, name, lat, lon, aliases = cols
+                    self.areas[area_id] = Area(area_id, city_id, name, float(lat), float(lon),
+                                               tuple(normalize_text(a) for a in aliases.split('|')))
+        # Every token of every city alias: these may follow an area alias ("Clifton Karachi")
+        self._city_tokens = {t for _, aliases in self.cities.values() for a in aliases for t in a}
+        self._build_rings()
+
+    def _build_rings(self):
+        # Precompute neighbour rings once at load; sort by distance then id so fan-out is deterministic
+        for area in self.areas.values():
+            dists = sorted(
+                (_haversine_km(area.lat, area.lon, o.lat, o.lon), o.area_id)
+                for o in self.areas.values() if o.area_id != area.area_id
+            )
+            rings, inner = [], 0.0
+            for outer in RING_RADII_KM:
+                rings.append(tuple(aid for d, aid in dists if inner < d <= outer))
+                inner = outer
+            area.rings = tuple(rings)
+
+    def resolve(self, text: str):
+        """Map free text to a ResolvedLocation, or None if unknown or ambiguous."""
+        tokens = normalize_text(text)
+        if not tokens:
+            return None
+        mentioned = self._mentioned_cities(tokens)
+
+        candidates = []
+        for area in self.areas.values():
+            matched = [a for a in area.aliases if _contains_at_boundary(tokens, a, self._city_tokens)]
+            if not matched:
+                continue
+            alias = max(matched, key=len)
+            candidates.append(((area.city_id in mentioned, len(alias)), area, alias))
+        if not candidates:
+            return None
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        score, area, alias = candidates[0]
+        if len(candidates) > 1 and candidates[1][0] == score:
+            # e.g. "Bahria Town" or "DHA" with no city: don't guess
+            return None
+        if mentioned and area.city_id not in mentioned:
+            # The user named a different city; only accept if the alias itself names it
+            # ("Bahria Town Islamabad" is the Rawalpindi-side development)
+            city_tokens = {t for cid in mentioned for a in self.cities[cid][1] for t in a}
+            if not city_tokens.intersection(alias):
+                return None
+        return self._to_resolved(area)
+
+    def resolve_city(self, text: str):
+        """Return the city_id when the text is nothing but one city's name ("khi", "Karachi, Pakistan")."""
+        tokens = normalize_text(text)
+        mentioned = self._mentioned_cities(tokens)
+        if len(mentioned) != 1:
+            return None
+        city_id = next(iter(mentioned))
+        allowed = {t for a in self.cities[city_id][1] for t in a} | {'pakistan'}
+        return city_id if all(t in allowed for t in tokens) else None
+
+    def _mentioned_cities(self, tokens: tuple) -> set:
+        return {cid for cid, (_, aliases) in self.cities.items() if any(_contains(tokens, a) for a in aliases)}
+
+    def nearby(self, area_id: str, max_rings: int = len(RING_RADII_KM)) -> list:
+        area = self.areas[area_id]
+        return [self.areas[aid] for ring in area.rings[:max_rings] for aid in ring]
+
+    def _to_resolved(self, area: Area) -> ResolvedLocation:
+        return ResolvedLocation(
+            area_id=area.area_id,
+            name=area.name,
+            city=self.cities[area.city_id][0],
+            nearby=[o.name for o in self.nearby(area.area_id)],
+        )
+
+
+@lru_cache(maxsize=1)
+def get_gazetteer():
+    return Gazetteer(GAZETTEER_PATH)
+
+
+def resolve_location(text: str):
+    """Resolve free text against the shipped gazetteer; never raises, returns None when unresolved."""
+    try:
+        return get_gazetteer().resolve(text)
+    except Exception as e:
+        print('[GAZETTEER] lookup failed:', e)
+        return None
+
+
+def canonical_location_key(text: str, resolved=_UNSET) -> str:
+    """Stable key for a location: the area id, else the city id for city-only text, else the normalized text.
+
+    Pass the result of an earlier resolve_location() call (including None) to skip resolving again.
+    """
+    if resolved is _UNSET:
+        resolved = resolve_location(text)
+    if resolved:
+        return resolved.area_id
+    try:
+        city_id = get_gazetteer().resolve_city(text)
+    except Exception as e:
+        print('[GAZETTEER] city lookup failed:', e)
+        city_id = None
+    return city_id or ' '.join(normalize_text(text))
@@ -2,7 +2,13 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import json
+import math
 from config import client
+from gazetteer import canonical_location_key, resolve_location
+from resilience import (
+    Deadline, DeadlineExceeded, UpstreamError, PermanentUpstreamError,
+    call_with_retry, classify_error, error_for_status, parse_retry_after,
+)
 import os
 import requests
 import traceback
@@ -45,25 +51,30 @@ if GEMINI_API_KEY:
 # ---------------------------------------------------------------------------------
 
 
-def _invoke_model(model_name: str, input_text: str, use_search_tools: bool = False):
+def _invoke_model(model_name: str, input_text: str, use_search_tools: bool = False, timeout: float = None):
     """Invoke the configured model. By default this calls the existing `client.responses.create`.
     If MODEL_SWITCH == 'G' this will attempt to call the Gemini-style HTTP endpoint pointed to by
     GEMINI_ENDPOINT using GEMINI_API_KEY. The returned object will be either the original SDK
     response or a lightweight dict with fields compatible with the rest of this file (output_text, usage, model).
+    `timeout` caps the network wait in seconds (defaults to 60). Gemini error responses are raised as
+    classified UpstreamError subclasses so callers can decide whether to retry.
     """
+    timeout = 60 if timeout is None else min(60, timeout)
     # Original (default) path: use existing client from config
     if MODEL_SWITCH != 'G':
-        return client.responses.create(
+        # SDK retries off on this path only: call_with_retry retries it and owns the deadline
+        return client.with_options(max_retries=0).responses.create(
             model=model_name,
             input=input_text,
-            tools=[{"type": "web_search"}] if use_search_tools else None
+            tools=[{"type": "web_search"}] if use_search_tools else None,
+            timeout=timeout
         )
 
     # Gemini testing path: use a simple HTTP POST to GEMINI_ENDPOINT and return a dict-like response
     # NOTE: This is intended as a temporary, test-only shim. If you later remove Gemini support,
     # comment out the block below (everything inside this if MODEL_SWITCH == 'G') and set MODEL_SWITCH back to 'O'.
     if not GEMINI_ENDPOINT:
-        raise RuntimeError('GEMINI_ENDPOINT not configured. Set GEMINI_ENDPOINT in .env (e.g. https://generativelanguage.googleapis.com/v1beta/models/' + GEMINI_MODEL + ':generateContent)')
+        raise PermanentUpstreamError('GEMINI_ENDPOINT not configured. Set GEMINI_ENDPOINT in .env (e.g. https://generativelanguage.googleapis.com/v1beta/models/' + GEMINI_MODEL + ':generateContent)')
     # Gemini expects X-goog-api-key header and a contents/parts body per docs
     headers = {
         'Content-Type': 'application/json',
@@ -80,10 +91,13 @@ def _invoke_model(model_name: str, input_text: str, use_search_tools: bool = Fal
     }
 
     # Use GEMINI_MODEL via endpoint URL (e.g., /gemini-2.5-pro:generateContent)
-    resp = requests.post(GEMINI_ENDPOINT, headers=headers, json=gemini_payload, timeout=60)
+    resp = requests.post(GEMINI_ENDPOINT, headers=headers, json=gemini_payload, timeout=timeout)
+    retry_after = parse_retry_after(resp.headers.get('Retry-After'))
     try:
         resp_json = resp.json()
     except Exception:
+        if resp.status_code >= 400:
+            raise error_for_status(resp.status_code, f"Gemini HTTP {resp.status_code}: {resp.text[:200]}", retry_after)
         # Fallback: return raw text
         print("[GEMINI DEBUG] response.text (non-json):", resp.text[:1000])
         return {
@@ -105,7 +119,10 @@ def _invoke_model(model_name: str, input_text: str, use_search_tools: bool = Fal
             code = error_info.get('code')
             message = error_info.get('message', '')
             print(f"[GEMINI ERROR] Code {code}: {message}")
-            raise RuntimeError(f"Gemini API error {code}: {message}")
+            status = code if isinstance(code, int) else resp.status_code
+            raise error_for_status(status, f"Gemini API error {code}: {message}", retry_after)
+    if resp.status_code >= 400:
+        raise error_for_status(resp.status_code, f"Gemini HTTP {resp.status_code}", retry_after)
 
     # Attempt to extract text from common Gemini response shapes
     out_text = None
@@ -228,6 +245,15 @@ def _get_usage_info(resp):
         return {}
 
 
+def _upstream_http_error(err, prefix):
+    """Translate a classified upstream failure into the HTTP error returned to the client."""
+    if err.retryable or isinstance(err, DeadlineExceeded):
+        retry_after = max(1, math.ceil(err.retry_after or 0))
+        return HTTPException(status_code=503, detail=f"{prefix}: {str(err)}",
+                             headers={'Retry-After': str(retry_after)})
+    return HTTPException(status_code=500, detail=f"{prefix}: {str(err)}")
+
+
 # Enable CORS for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -249,19 +275,36 @@ class NlpRequest(BaseModel):
 class ChatResponse(BaseModel):
     providers: list
     usage_report: dict
+    partial: bool = False  # True when upstream failures/deadline cut the search short
 
 class NlpResponse(BaseModel):
     valid: bool
     providers: list = []
     usage_report: dict = {}
 
+# Sync (plain def) endpoints: FastAPI runs them in its threadpool, so blocking model calls and
+# retry backoff sleeps don't stall the event loop for other requests
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+def chat_endpoint(request: ChatRequest):
     try:
+        # Normalize free-text location against the local gazetteer so nearby-area expansion is
+        # resolved here (deterministic, no search tokens) instead of left to the model
+        resolved = resolve_location(request.location)
+        location_key = canonical_location_key(request.location, resolved)
+        # The user's own text stays in the prompt (it may carry a street or house number);
+        # the canonical area and nearby list are added as hints only
+        area_hint = f'This location is in {resolved.display}.\n' if resolved else ''
+        if resolved and resolved.nearby:
+            nearby_rule = ("If exact matches are not found, search these nearby areas in this order: "
+                           + ", ".join(resolved.nearby) + ". Add a field \"location_note\": \"NEARBY\" for those.")
+        else:
+            nearby_rule = 'If exact matches are not found, expand outward to the nearest areas and add a field "location_note": "NEARBY".'
+        print(f"[LOCATION] {request.location!r} -> key={location_key} nearby={len(resolved.nearby) if resolved else 0}")
+
     # Build prompt using the same logic as inference.py
         query = f"""
 Find the top {request.count} "{request.service}" specialists in "{request.location}".
-If exact matches are not found, expand outward to the nearest areas and add a field "location_note": "NEARBY".
+{area_hint}{nearby_rule}
 If information is sparse, still include it but mark with "confidence": "LOW".
 Return ONLY valid JSON in this format:
 
@@ -281,13 +324,18 @@ No extra commentary, only JSON.
         # Call configured model (original client or Gemini test shim)
         # Use appropriate model based on MODEL_SWITCH
         model_to_use = GEMINI_MODEL if MODEL_SWITCH == 'G' else "gpt-4o"
+        # One time budget covers the initial search, its retries and every top-up pass
+        deadline = Deadline()
+        partial = False
         try:
-            response = _invoke_model(model_to_use, query, use_search_tools=True)
-        except Exception as e:
+            response = call_with_retry(
+                lambda t: _invoke_model(model_to_use, query, use_search_tools=True, timeout=t),
+                deadline, label='chat')
+        except UpstreamError as e:
             tb = traceback.format_exc()
             print("LLM request failed:", e)
             print(tb)
-            raise HTTPException(status_code=500, detail=f"LLM request failed: {str(e)}")
+            raise _upstream_http_error(e, "LLM request failed")
 
         # Helpers: robustly extract text and usage from varying SDK shapes
         def _get_response_text(resp):
@@ -385,6 +433,10 @@ No extra commentary, only JSON.
         attempts = 0
         model_for_top_up = GEMINI_MODEL if MODEL_SWITCH == 'G' else 'gpt-4o'
         while isinstance(providers, list) and len(providers) < request.count and attempts < 2:
+            if deadline.expired():
+                print('[TOP-UP] deadline reached, returning partial results')
+                partial = True
+                break
             remaining = request.count - len(providers)
             attempts += 1
             existing_names = [p.get('name') for p in providers if isinstance(p, dict) and p.get('name')]
@@ -408,7 +460,9 @@ Please return ONLY {remaining} additional DISTINCT providers not in the list abo
 If none, return []. No commentary.
 """
             try:
-                add_resp = _invoke_model(model_for_top_up, top_up_prompt, use_search_tools=True)
+                add_resp = call_with_retry(
+                    lambda t: _invoke_model(model_for_top_up, top_up_prompt, use_search_tools=True, timeout=t),
+                    deadline, label=f'top-up {attempts}')
                 add_text = _get_response_text(add_resp)
                 print(f"[TOP-UP] attempt={attempts} remaining={remaining} raw_length={len(add_text)}")
                 extra = _parse_providers(add_text)
@@ -429,7 +483,10 @@ If none, return []. No commentary.
                 else:
                     print('[TOP-UP] parse failed (attempt', attempts, ') raw:', add_text[:200])
             except Exception as tu_err:
-                print('[TOP-UP] attempt failed:', tu_err)
+                # Keep what we already found rather than failing the whole request
+                err = classify_error(tu_err)
+                print(f'[TOP-UP] attempt failed: status={err.status} retryable={err.retryable} error={tu_err}')
+                partial = True
                 break
         # Trim to requested count
         if isinstance(providers, list) and len(providers) > request.count:
@@ -457,18 +514,20 @@ If none, return []. No commentary.
         }
 
         try:
-            return ChatResponse(providers=providers, usage_report=usage_report)
+            return ChatResponse(providers=providers, usage_report=usage_report, partial=partial)
         except Exception as build_err:
             print('[CHAT DEBUG] Failed constructing ChatResponse:', build_err)
             print('[CHAT DEBUG] providers sample:', providers[:2] if isinstance(providers, list) else providers)
             print('[CHAT DEBUG] usage_report:', usage_report)
             raise HTTPException(status_code=500, detail='Result formatting failure')
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/nlp", response_model=NlpResponse)
-async def nlp_endpoint(request: NlpRequest):
+def nlp_endpoint(request: NlpRequest):
     try:
         # First, validate if the query is service-related
         validation_query = f"""
@@ -497,13 +556,16 @@ Examples of INVALID queries:
         # Call configured model for validation
         # Use appropriate model based on MODEL_SWITCH
         model_to_use = GEMINI_MODEL if MODEL_SWITCH == 'G' else "gpt-4o"
+        deadline = Deadline()
         try:
-            validation_response = _invoke_model(model_to_use, validation_query, use_search_tools=False)
-        except Exception as e:
+            validation_response = call_with_retry(
+                lambda t: _invoke_model(model_to_use, validation_query, use_search_tools=False, timeout=t),
+                deadline, label='nlp validation')
+        except UpstreamError as e:
             tb = traceback.format_exc()
             print("NLP validation request failed:", e)
             print(tb)
-            raise HTTPException(status_code=500, detail=f"NLP validation failed: {str(e)}")
+            raise _upstream_http_error(e, "NLP validation failed")
 
         # Extract text robustly
         def _get_text(resp):
@@ -551,12 +613,14 @@ No extra commentary, only JSON.
         # Use appropriate model based on MODEL_SWITCH
         model_to_use = GEMINI_MODEL if MODEL_SWITCH == 'G' else "gpt-4o"
         try:
-            response = _invoke_model(model_to_use, extraction_query, use_search_tools=True)
-        except Exception as e:
+            response = call_with_retry(
+                lambda t: _invoke_model(model_to_use, extraction_query, use_search_tools=True, timeout=t),
+                deadline, label='nlp extraction')
+        except UpstreamError as e:
             tb = traceback.format_exc()
             print("NLP extraction request failed:", e)
             print(tb)
-            raise HTTPException(status_code=500, detail=f"NLP extraction failed: {str(e)}")
+            raise _upstream_http_error(e, "NLP extraction failed")
 
         raw_text = _get_response_text(response)
         try:
@@ -585,6 +649,8 @@ No extra commentary, only JSON.
 
         return NlpResponse(valid=True, providers=providers, usage_report=usage_report)
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,155 @@
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# --- Retry / deadline tuning (override via environment or .env) -------------------
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv('UPSTREAM_MAX_ATTEMPTS', '3') or 3)
+UPSTREAM_BACKOFF_BASE = float(os.getenv('UPSTREAM_BACKOFF_BASE', '0.5') or 0.5)
+UPSTREAM_BACKOFF_CAP = float(os.getenv('UPSTREAM_BACKOFF_CAP', '8') or 8)
+# Overall wall-clock budget for one API request, including every retry and top-up pass
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '90') or 90)
+
+# HTTP statuses worth retrying: rate limiting, timeouts and transient server failures
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class UpstreamError(RuntimeError):
+    """Base class for failures talking to the model provider."""
+
+    retryable = False
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TransientUpstreamError(UpstreamError):
+    """Rate limits, timeouts, connection drops and 5xx responses - safe to retry."""
+
+    retryable = True
+
+
+class PermanentUpstreamError(UpstreamError):
+    """Bad requests, auth failures and misconfiguration - retrying will not help."""
+
+
+class DeadlineExceeded(UpstreamError):
+    """The per-request time budget ran out before the upstream call could finish."""
+
+
+class Deadline:
+    """Wall-clock budget shared by every upstream call made for one API request."""
+
+    def __init__(self, seconds=None):
+        self.seconds = REQUEST_DEADLINE_SECONDS if seconds is None else seconds
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def parse_retry_after(value):
+    """Return the Retry-After header value in seconds (delta or HTTP date), or None."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def error_for_status(status, message, retry_after=None):
+    """Build the classified error for an upstream HTTP status code."""
+    if status in RETRYABLE_STATUS:
+        return TransientUpstreamError(message, status=status, retry_after=retry_after)
+    return PermanentUpstreamError(message, status=status, retry_after=retry_after)
+
+
+def classify_error(exc):
+    """Map any exception raised by an upstream call onto the UpstreamError hierarchy."""
+    if isinstance(exc, UpstreamError):
+        return exc
+    if isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return TransientUpstreamError(str(exc))
+
+    # OpenAI SDK errors expose status_code and the underlying httpx response;
+    # connection/timeout errors carry neither. Duck-type so the SDK import stays optional.
+    name = type(exc).__name__
+    if name in ('APITimeoutError', 'APIConnectionError'):
+        return TransientUpstreamError(str(exc))
+    status = getattr(exc, 'status_code', None)
+    if isinstance(status, int):
+        response = getattr(exc, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        return error_for_status(status, str(exc), parse_retry_after(headers.get('retry-after')))
+    return PermanentUpstreamError(str(exc))
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Capped exponential backoff with full jitter; a server Retry-After is a minimum wait."""
+    ceiling = min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * (2 ** attempt))
+    delay = random.uniform(0, ceiling)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _reraise(err, original):
+    # classify_error hands UpstreamErrors back unchanged; don't make them their own cause
+    if err is original:
+        raise err
+    raise err from original
+
+
+def call_with_retry(fn, deadline, label='upstream', max_attempts=None, sleep=time.sleep):
+    """Call fn(timeout) until it succeeds, a permanent error occurs, or the budget runs out.
+
+    fn receives the seconds left on the deadline so it can bound its own network timeout.
+    Always raises an UpstreamError subclass on failure.
+    """
+    max_attempts = max_attempts or UPSTREAM_MAX_ATTEMPTS
+    last_err = None
+    for attempt in range(max_attempts):
+        if deadline.expired():
+            break
+        try:
+            return fn(deadline.remaining())
+        except Exception as e:
+            err = classify_error(e)
+            last_err = err
+            print(f"[RETRY] {label} attempt={attempt + 1}/{max_attempts} status={err.status} "
+                  f"retryable={err.retryable} error={err}")
+            if not err.retryable or attempt + 1 >= max_attempts:
+                _reraise(err, e)
+            if err.retry_after is not None and (err.retry_after > UPSTREAM_BACKOFF_CAP
+                                                or err.retry_after >= deadline.remaining()):
+                # Server asked us to back off longer than we can wait: give up now and
+                # hand its Retry-After to the client instead of retrying early
+                _reraise(err, e)
+            delay = backoff_delay(attempt, err.retry_after)
+            if delay >= deadline.remaining():
+                break
+            sleep(delay)
+    raise DeadlineExceeded(
+        f"{label} did not complete within {deadline.seconds:.0f}s"
+        + (f" (last error: {last_err})" if last_err else ''),
+        status=getattr(last_err, 'status', None),
+        retry_after=getattr(last_err, 'retry_after', None),
+    )
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Tests import the backend modules directly (main, resilience, gazetteer) like the app does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config.py refuses to import without a key; the fake backend never sends it anywhere
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+os.environ['MODEL_SWITCH'] = 'O'
@@ -0,0 +1,87 @@
+import pytest
+
+from gazetteer import GAZETTEER_PATH, Gazetteer, canonical_location_key
+
+
+@pytest.fixture(scope='module')
+def gazetteer():
+    return Gazetteer(GAZETTEER_PATH)
+
+
+@pytest.mark.parametrize('text, area_id', [
+    ('Bahria Town Karachi', 'khi-bahria-town'),
+    ('bahria town, khi', 'khi-bahria-town'),
+    ('Bahria Town Islamabad', 'rwp-bahria-town'),
+    ('House 12, Street 4, DHA Phase 6, Karachi', 'khi-dha'),
+    ('Gulshan-e-Iqbal Block 13, Karachi', 'khi-gulshan'),
+    ('F.B. Area Karachi', 'khi-fb-area'),
+    ('G-9 Islamabad', 'isb-g9'),
+    ('DHA', None),
+    ('Saddar', None),
+    ('Bahria Town', None),
+    ('Clifton, Lahore', None),
+    ('Gulshan-e-Maymar, Karachi', None),
+    ('Gulshan-e-Hadeed Karachi', None),
+    ('Defence View, Karachi', None),
+    ('Defence Road Lahore', None),
+    ('Defence Housing Authority, Lahore', 'lhe-dha'),
+    ('Chicago, IL', None),
+])
+def test_resolve(gazetteer, text, area_id):
+    resolved = gazetteer.resolve(text)
+    assert (resolved.area_id if resolved else None) == area_id
+
+
+def test_ring_order_is_stable(gazetteer):
+    first = [a.area_id for a in gazetteer.nearby('khi-clifton')]
+    assert first == [a.area_id for a in Gazetteer(GAZETTEER_PATH).nearby('khi-clifton')]
+    assert first[:3] == ['khi-dha', 'khi-saddar', 'khi-pechs']
+    assert 'khi-clifton' not in first
+
+
+@pytest.mark.parametrize('text, key', [
+    ('Karachi', 'karachi'),
+    ('khi', 'karachi'),
+    ('Bahria Town Karachi', 'khi-bahria-town'),
+    ('bahria town, khi', 'khi-bahria-town'),
+    ('Chicago, IL', 'chicago il'),
+])
+def test_canonical_location_key(text, key):
+    assert canonical_location_key(text) == key
+
+
+def test_canonical_location_key_reuses_unresolved_result(monkeypatch):
+    import gazetteer
+
+    def fail(text):
+        raise AssertionError('resolved twice')
+
+    monkeypatch.setattr(gazetteer, 'resolve_location', fail)
+    assert canonical_location_key('khi', None) == 'karachi'
+    assert canonical_location_key('Somewhere Else', None) == 'somewhere else'
+
+
+def test_bad_row_reports_line_number(tmp_path):
+    path = tmp_path / 'gazetteer.tsv'
+    path.write_text('# header\nC\tkarachi\tKarachi\tkarachi\nA\tkhi-clifton\tkarachi\tClifton\n', encoding='utf-8')
+    with pytest.raises(ValueError, match=r'gazetteer.tsv:3: A row needs 7 columns, got 4'):
+        Gazetteer(str(path))
+
+
+def test_chat_prompt_keeps_user_location_and_adds_hints(monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+
+    prompts = []
+
+    def fake_invoke(model_name, input_text, use_search_tools=False, timeout=None):
+        prompts.append(input_text)
+        return type('FakeResponse', (), {'output_text': '[]', 'usage': None, 'model': 'fake'})()
+
+    monkeypatch.setattr(main, '_invoke_model', fake_invoke)
+    location = 'House 12, Street 4, DHA Phase 6, Karachi'
+    resp = TestClient(main.app).post('/api/chat', json={'service': 'plumber', 'location': location, 'count': 1})
+    assert resp.status_code == 200
+    assert all(location in p for p in prompts)
+    assert 'This location is in DHA Karachi.' in prompts[0]
+    assert 'Clifton' in prompts[0]
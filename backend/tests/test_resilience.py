@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+from fastapi.testclient import TestClient
+
+import main
+import resilience
+from resilience import (
+    Deadline, DeadlineExceeded, PermanentUpstreamError, TransientUpstreamError,
+    call_with_retry, error_for_status,
+)
+
+
+class FakeBackend:
+    """Fault-injecting stand-in for the upstream model: replays a script of outcomes in order.
+
+    Each step is either an exception to raise or the text the model "returns".
+    """
+
+    def __init__(self, *steps):
+        self.steps = list(steps)
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        step = self.steps.pop(0) if len(self.steps) > 1 else self.steps[0]
+        if isinstance(step, Exception):
+            raise step
+        return type('FakeResponse', (), {'output_text': step, 'usage': None, 'model': 'fake'})()
+
+
+def _no_sleep(_):
+    pass
+
+
+@pytest.mark.parametrize('fault', [
+    error_for_status(429, 'rate limited'),
+    error_for_status(503, 'unavailable'),
+    requests.exceptions.Timeout('read timed out'),
+])
+def test_transient_errors_stop_at_max_attempts(fault):
+    backend = FakeBackend(fault)
+    with pytest.raises(TransientUpstreamError):
+        call_with_retry(backend, Deadline(30), sleep=_no_sleep)
+    assert backend.calls == resilience.UPSTREAM_MAX_ATTEMPTS
+
+
+def test_transient_error_then_success():
+    backend = FakeBackend(error_for_status(503, 'unavailable'), 'ok')
+    resp = call_with_retry(backend, Deadline(30), sleep=_no_sleep)
+    assert resp.output_text == 'ok'
+    assert backend.calls == 2
+
+
+def test_permanent_error_is_not_retried():
+    backend = FakeBackend(error_for_status(400, 'bad request'))
+    with pytest.raises(PermanentUpstreamError):
+        call_with_retry(backend, Deadline(30), sleep=_no_sleep)
+    assert backend.calls == 1
+
+
+def test_expired_deadline_makes_no_calls():
+    backend = FakeBackend('ok')
+    with pytest.raises(DeadlineExceeded):
+        call_with_retry(backend, Deadline(0), sleep=_no_sleep)
+    assert backend.calls == 0
+
+
+def test_deadline_stops_retries():
+    def slow_failure(timeout):
+        slow_failure.calls += 1
+        time.sleep(0.05)
+        raise error_for_status(503, 'unavailable')
+    slow_failure.calls = 0
+
+    with pytest.raises(DeadlineExceeded):
+        call_with_retry(slow_failure, Deadline(0.12), max_attempts=50, sleep=_no_sleep)
+    assert slow_failure.calls < 50
+
+
+def test_long_retry_after_gives_up_without_retrying():
+    sleeps = []
+    backend = FakeBackend(error_for_status(429, 'slow down', retry_after=30))
+    with pytest.raises(TransientUpstreamError) as exc_info:
+        call_with_retry(backend, Deadline(60), sleep=sleeps.append)
+    assert backend.calls == 1
+    assert sleeps == []
+    assert exc_info.value.retry_after == 30
+
+
+def test_short_retry_after_is_a_minimum_wait():
+    sleeps = []
+    backend = FakeBackend(error_for_status(429, 'slow down', retry_after=2), 'ok')
+    call_with_retry(backend, Deadline(60), sleep=sleeps.append)
+    assert sleeps and sleeps[0] >= 2
+
+
+# --- /api/chat against the fake backend ---------------------------------------------
+
+FIRST_PASS = json.dumps([{'name': 'Ali Plumbing', 'phone': '1', 'details': '', 'address': '',
+                          'location_note': 'EXACT', 'confidence': 'HIGH'}])
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def _chat(client, count=3):
+    return client.post('/api/chat', json={'service': 'plumber', 'location': 'Clifton Karachi', 'count': count})
+
+
+def test_chat_returns_partial_when_top_up_fails(client, monkeypatch):
+    backend = FakeBackend(FIRST_PASS, error_for_status(400, 'bad request'))
+    monkeypatch.setattr(main, '_invoke_model', backend)
+    resp = _chat(client)
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body['partial'] is True
+    assert [p['name'] for p in body['providers']] == ['Ali Plumbing']
+
+
+def test_chat_returns_partial_when_top_up_output_is_malformed(client, monkeypatch):
+    backend = FakeBackend(FIRST_PASS, json.dumps([{'name': 42}]))
+    monkeypatch.setattr(main, '_invoke_model', backend)
+    resp = _chat(client)
+    assert resp.status_code == 200
+    assert resp.json()['partial'] is True
+    assert [p['name'] for p in resp.json()['providers']] == ['Ali Plumbing']
+
+
+def test_chat_complete_result_is_not_partial(client, monkeypatch):
+    monkeypatch.setattr(main, '_invoke_model', FakeBackend(FIRST_PASS))
+    resp = _chat(client, count=1)
+    assert resp.status_code == 200
+    assert resp.json()['partial'] is False
+
+
+def test_chat_initial_rate_limit_maps_to_503_with_retry_after(client, monkeypatch):
+    backend = FakeBackend(error_for_status(429, 'slow down', retry_after=30))
+    monkeypatch.setattr(main, '_invoke_model', backend)
+    resp = _chat(client)
+    assert resp.status_code == 503
+    assert resp.headers['retry-after'] == '30'
+    assert backend.calls == 1
+
+
+def test_upstream_http_error_rounds_retry_after_up():
+    err = main._upstream_http_error(error_for_status(503, 'x', retry_after=0.5), 'prefix')
+    assert err.status_code == 503
+    assert err.headers['Retry-After'] == '1'
+    err = main._upstream_http_error(DeadlineExceeded('out of time'), 'prefix')
+    assert err.headers['Retry-After'] == '1'
+
+
+def test_backoff_does_not_block_other_requests(monkeypatch):
+    first_call = threading.Event()
+
+    def backing_off(*args, **kwargs):
+        if not first_call.is_set():
+            first_call.set()
+            # 1s Retry-After: the retry loop sleeps before trying again
+            raise error_for_status(503, 'unavailable', retry_after=1)
+        return FakeBackend(FIRST_PASS)()
+
+    monkeypatch.setattr(main, '_invoke_model', backing_off)
+    with TestClient(main.app) as shared:
+        chat = threading.Thread(target=_chat, args=(shared, 1))
+        chat.start()
+        assert first_call.wait(5)
+        started = time.monotonic()
+        assert shared.get('/api/health').status_code == 200
+        assert time.monotonic() - started < 0.5
+        chat.join()